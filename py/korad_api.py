@@ -10,10 +10,17 @@ Implemented as both:
 
 import re as _re
 import atexit as _atexit
+import os as _os
+import queue as _queue
+import select as _select
 import serial as _serial
-from time import sleep as _sleep
+import threading as _threading
+import weakref as _weakref
+from collections import OrderedDict as _OrderedDict
+from concurrent.futures import Future as _Future
+from time import sleep as _sleep, monotonic as _monotonic
 from numbers import Real as _Real
-from typing import Dict as _Dict, Union as _Union
+from typing import Dict as _Dict, List as _List, Tuple as _Tuple, Union as _Union
 
 _ver_num = (0,0,1)
 __version__ = '.'.join(map(str,_ver_num))
@@ -25,24 +32,63 @@ _KORAD_DATA_BITS = _serial.EIGHTBITS
 _KORAD_STOP_BITS = _serial.STOPBITS_ONE
 _KORAD_DATA_FLOW_CTRL = False
 _KORAD_MAX_TIMEOUT = 100e-3  # max timeout in seconds 
+_KORAD_INTER_BYTE_TIMEOUT = 10e-3  # replies are sent in one go, a gap means the reply is over
+_KORAD_SET_DELAY = 50e-3  # time the PSU needs to process a set command
+_KORAD_STATUS_TTL = 50e-3  # how long a status read is reused for
+# longest expected replies, anything longer is cut off there
+_KORAD_MAX_NUMERIC_REPLY = 16  # status byte and readings, e.g. '30.00'
+_KORAD_MAX_ID_REPLY = 64  # e.g. 'KORAD KD3005P V2.0'
 
 # API CONSTANTS
 _KORAD_ID_CMD = b'*IDN?'
 _KORAD_STATUS_CMD = b'STATUS?'
-_KORAD_SAVE_CMD = lambda x: 'SAV{}'.format(x).encode('utf-8')
-_KORAD_RECALL_CMD = lambda x: 'RCL{}'.format(x).encode('utf-8')
-_KORAD_OCP_CMD = lambda x: 'OCP{}'.format(x).encode('utf-8')
-_KORAD_OUTPUT_CMD = lambda x: 'OUT{}'.format(x).encode('utf-8')
-_KORAD_VSET_CMD = lambda x, y: 'VSET{}:{}'.format(x,y).encode('utf-8')
-_KORAD_ISET_CMD = lambda x, y: 'ISET{}:{}'.format(x,y).encode('utf-8')
-_KORAD_VREAD_CMD = lambda x: 'VSET{}?'.format(x).encode('utf-8')
-_KORAD_IREAD_CMD = lambda x: 'ISET{}?'.format(x).encode('utf-8')
-_KORAD_VMEAS_CMD = lambda x: 'VOUT{}?'.format(x).encode('utf-8')
-_KORAD_IMEAS_CMD = lambda x: 'IOUT{}?'.format(x).encode('utf-8')
-
-# korad model number regex
-# http://www.pyregex.com/?id=eyJyZWdleCI6Ii4qayg%2FUDxwYW5lbD5hfGQpKD9QPHZvbHRhZ2U%2BXFxkKSg%2FUDxjaGFubmVscz5cXGQpKD9QPGN1cnJlbnQ%2BXFxkKylwLioiLCJmbGFncyI6MiwibWF0Y2hfdHlwZSI6Im1hdGNoIiwidGVzdF9zdHJpbmciOiJSTkQgMzIwLUtEMzAwNVAgVjIuMCJ9
-_KORAD_MODEL_REGEX = _re.compile(r'.*k(?P<panel>a|d)(?P<max_voltage>\d)(?P<channels>\d)(?P<max_current>\d+)p.*',_re.I)
+_KORAD_SAVE_CMD = lambda x: b'SAV%d' % x
+_KORAD_RECALL_CMD = lambda x: b'RCL%d' % x
+_KORAD_OCP_CMD = lambda x: b'OCP%d' % x
+_KORAD_OUTPUT_CMD = lambda x: b'OUT%d' % x
+# settings resolution is 10mV and 1mA
+_KORAD_VSET_CMD = lambda x, y: b'VSET%d:%.2f' % (x,y)
+_KORAD_ISET_CMD = lambda x, y: b'ISET%d:%.3f' % (x,y)
+_KORAD_VREAD_CMD = lambda x: b'VSET%d?' % x
+_KORAD_IREAD_CMD = lambda x: b'ISET%d?' % x
+_KORAD_VMEAS_CMD = lambda x: b'VOUT%d?' % x
+_KORAD_IMEAS_CMD = lambda x: b'IOUT%d?' % x
+
+# korad model numbers follow K[A|D]<max voltage/10><channels><max current>P, e.g. KD3005P
+# matched against the upper-cased id so the plain ascii path is used instead of IGNORECASE
+_KORAD_MODEL_REGEX = _re.compile(rb'K([AD])(\d)(\d)(\d+)P')
+
+def _parse_model(id:bytes)->_Tuple[int,int,int]:
+    """
+    Infer (channels, max_voltage, max_current) from the model number in a raw id reply.
+    """
+    m = _KORAD_MODEL_REGEX.search(id.upper())
+    if m is None:
+        raise ValueError('Unrecognized Korad model: %r' % id)
+    _, max_voltage, channels, max_current = m.groups()
+    channels = 1 if channels == b'0' else 3
+    return channels, (max_voltage[0]-0x30)*10, int(max_current)
+
+def _clamp(val, lo, hi):
+    return lo if val < lo else hi if val > hi else val
+
+# status byte decoding, as described in notes, precomputed for every possible byte
+_STATUS_TABLE = [{'output':bool(s&(1<<6)),
+                  'mode':'CV' if s&1 else 'CC',
+                  'ocp':bool(s&(1<<5)),
+                  } for s in range(256)]
+
+def _close_port(port,cmd_q,q_lock,io_thread):
+    # let queued commands go out before the port is closed, unless this is the
+    # worker itself letting go of the last reference
+    with q_lock:
+        cmd_q.put(None)
+    if io_thread is not _threading.current_thread():
+        io_thread.join()
+    try:
+        port.close()
+    except Exception:
+        pass
 
 # OOP Interface
 # todo: maybe implement class/containers for save/recall settings, configurations
@@ -50,172 +96,541 @@ class Korad:
     """
     Korad abstraction object
     """
-    def __init__(self, addr:str, timeout:float=_KORAD_MAX_TIMEOUT, clamp:bool=True):
+    __slots__ = ('addr', 'clamp', 'timeout', 'status_ttl',
+                 '_info', '_open_lock',
+                 '_port', '_fd', '_buf', '_ready_ts',
+                 '_status_cache', '_status_ts',
+                 '_last_output', '_last_ocp', '_last_v', '_last_i',
+                 '_cmd_q', '_q_lock', '_io_lock', '_io_error', '_io_thread', '_finalizer',
+                 '__weakref__',
+                 )
+
+    def __init__(self, addr:str, timeout:float=_KORAD_MAX_TIMEOUT, clamp:bool=True,
+                 status_ttl:float=_KORAD_STATUS_TTL):
         self.addr = addr
         self.clamp = clamp
         self.timeout = timeout
-        self._port = _serial.serial_for_url(addr,
-                                           baudrate=_KORAD_BAUD,
-                                           parity=_KORAD_PARITY,
-                                           rtscts=_KORAD_DATA_FLOW_CTRL,
-                                           dsrdtr=_KORAD_DATA_FLOW_CTRL,
-                                           timeout=timeout
-                                           )
-        self.id, self.channels, self.max_voltage, self.max_current = self._identify()
-        _atexit.register(self.close)
-        # self.close = self._port.close
+        self.status_ttl = status_ttl
+        self._status_cache = None
+        self._status_ts = 0.0
+        self._forget_settings()
+        self._ready_ts = 0.0
+        self._buf = bytearray()
+        # the port is opened and the unit identified on first use, see connect()
+        self._info = None
+        self._open_lock = _threading.Lock()
+        self._port = None
+        self._io_thread = None
+
+    def connect(self):
+        """
+        Open the port and identify the unit now rather than on first use,
+        raising right away if the PSU can't be reached.
+        """
+        try:
+            self._open()
+            self._get_info()
+        except Exception:
+            # back to unopened, so connect() or first use can try again
+            with self._open_lock:
+                self.close()
+                self._port = None
+            raise
+
+    def _open(self):
+        with self._open_lock:
+            if self._port is not None:
+                return
+            port = _serial.serial_for_url(self.addr,
+                                          baudrate=_KORAD_BAUD,
+                                          parity=_KORAD_PARITY,
+                                          rtscts=_KORAD_DATA_FLOW_CTRL,
+                                          dsrdtr=_KORAD_DATA_FLOW_CTRL,
+                                          timeout=self.timeout
+                                          )
+            port.inter_byte_timeout = _KORAD_INTER_BYTE_TIMEOUT
+            # only native posix ports expose a descriptor select() can wait on, those
+            # are read directly and pyserial's own (unreliable) timeout is not used
+            self._fd = getattr(port, 'fd', None)
+            if self._fd is not None:
+                port.timeout = 0
+            # all port I/O happens on this thread, callers hand it commands through the queue
+            self._cmd_q = _queue.Queue()
+            self._q_lock = _threading.Lock()
+            self._io_lock = _threading.Lock()
+            self._io_error = None
+            self._io_thread = _threading.Thread(target=self._io_loop, args=(self._cmd_q,),
+                                                name='korad-io-%s' % self.addr, daemon=True)
+            self._io_thread.start()
+            # only refers to the port and worker, so an unused Korad can still be
+            # collected; runs when it is, or at exit at the latest
+            self._finalizer = _weakref.finalize(self, _close_port, port, self._cmd_q, self._q_lock, self._io_thread)
+            # set last, other threads take a non-None _port to mean everything above is ready
+            self._port = port
+
+    def _get_info(self):
+        if self._info is None:
+            self._info = self._identify()
+        return self._info
+
+    @property
+    def id(self)->str:
+        return self._get_info()[0]
+
+    @property
+    def channels(self)->int:
+        return self._get_info()[1]
+
+    @property
+    def max_voltage(self)->int:
+        return self._get_info()[2]
+
+    @property
+    def max_current(self)->int:
+        return self._get_info()[3]
     
-    def _send_cmd(self,cmd):
-        self._port.write(cmd)
-        _sleep(self.timeout)
+    def _wait_ready(self):
+        # set commands are not acknowledged, so instead of sleeping after every
+        # write only wait out whatever is left of the last one's processing time
+        remaining = self._ready_ts - _monotonic()
+        if remaining > 0:
+            _sleep(remaining)
+
+    @staticmethod
+    def _io_loop(cmd_q):
+        # queued commands carry their Korad, so it stays alive until they are
+        # done but the idle thread itself holds no reference to it
+        while True:
+            item = cmd_q.get()
+            if item is None:
+                cmd_q.task_done()
+                break
+            psu, cmds, future, max_bytes = item
+            with psu._io_lock:
+                try:
+                    psu._wait_ready()
+                    if future is not None:
+                        psu._drop_input()
+                    psu._port.write(b''.join(cmds))
+                    psu._port.flush()
+                    if future is None:
+                        # the PSU works through a burst one set command at a time
+                        psu._ready_ts = _monotonic() + _KORAD_SET_DELAY*len(cmds)
+                    else:
+                        future.set_result(psu._read_replies(cmds, max_bytes))
+                except Exception as e:
+                    if future is None:
+                        # nobody waits on a write, report it on the next command instead
+                        psu._io_error = e
+                    else:
+                        future.set_exception(e)
+            psu = item = future = None
+            cmd_q.task_done()
+
+    def _check_io(self):
+        if self._port is None:
+            self._open()
+        if not self._finalizer.alive:
+            raise _serial.SerialException('Attempting to use a port that is not open')
+        error, self._io_error = self._io_error, None
+        if error is not None:
+            # the failed write may or may not have reached the PSU
+            self._forget_settings()
+            raise error
+
+    def _submit(self,cmds,future=None,max_bytes=_KORAD_MAX_NUMERIC_REPLY):
+        self._check_io()
+        # close() queues the worker's stop under the same lock, so nothing can be
+        # queued behind it and then wait forever for a reply
+        with self._q_lock:
+            if not self._finalizer.alive:
+                raise _serial.SerialException('Attempting to use a port that is not open')
+            self._cmd_q.put((self, cmds, future, max_bytes))
+
+    def _write(self,cmd):
+        self._submit([cmd])
+
+    def _query(self,cmd,max_bytes=_KORAD_MAX_NUMERIC_REPLY):
+        return self._query_many([cmd], max_bytes)[0]
+
+    def _query_many(self,cmds,max_bytes=_KORAD_MAX_NUMERIC_REPLY)->_List[bytes]:
+        """
+        Pipeline several queries: send them back to back and then collect one
+        reply per command, in order.
+        """
+        future = _Future()
+        self._submit(cmds, future, max_bytes)
+        return future.result()
+
+    def _drop_input(self):
+        # anything still buffered is a late reply to an earlier query, which
+        # would otherwise be taken for the reply to the next one
+        self._buf.clear()
+        self._port.reset_input_buffer()
+
+    def _read_replies(self,cmds,max_bytes=_KORAD_MAX_NUMERIC_REPLY)->_List[bytes]:
+        try:
+            return [self._read_status() if cmd == _KORAD_STATUS_CMD else self._read_reply(max_bytes)
+                    for cmd in cmds]
+        except Exception:
+            self._drop_input()
+            raise
+
+    def _fill(self,deadline,gap=False)->bool:
+        """
+        Wait for more input and append it to the receive buffer. Returns False
+        if nothing arrived before `deadline`, or within the inter-byte gap.
+        """
+        remaining = deadline - _monotonic()
+        if gap:
+            remaining = min(remaining, _KORAD_INTER_BYTE_TIMEOUT)
+        ready, _, _ = _select.select([self._fd], [], [], max(remaining, 0))
+        if not ready:
+            return False
+        chunk = _os.read(self._fd, 64)
+        if not chunk:
+            raise _serial.SerialException('device reports readiness to read but returned no data')
+        self._buf += chunk
+        return True
+
+    def _read_status(self)->bytes:
+        """
+        Read the STATUS? reply: exactly one raw byte, which can itself be
+        b'\n', followed by its terminator.
+        """
+        if self._fd is None:
+            status = self._port.read(1)
+            if not status:
+                raise TimeoutError('No reply from %s' % self.addr)
+            self._port.read_until(b'\n', 1)
+            return status
+        deadline = _monotonic() + self.timeout
+        buf = self._buf
+        if not buf and not self._fill(deadline):
+            raise TimeoutError('No reply from %s' % self.addr)
+        status = bytes(buf[:1])
+        del buf[:1]
+        if (buf or self._fill(deadline, gap=True)) and buf[:1] == b'\n':
+            del buf[:1]
+        return status
+
+    def _read_reply(self,max_bytes=_KORAD_MAX_NUMERIC_REPLY)->bytes:
+        """
+        Read a single reply, returning as soon as its terminating newline
+        arrives, `max_bytes` have been read or the reply stops short.
+        Raises TimeoutError if nothing arrives within `timeout`.
+        """
+        if self._fd is None:
+            line = self._port.read_until(b'\n', max_bytes)
+            if not line:
+                raise TimeoutError('No reply from %s' % self.addr)
+            return line
+        deadline = _monotonic() + self.timeout
+        # pipelined replies can arrive in one chunk, keep whatever follows the
+        # current line around for the next call
+        buf = self._buf
+        end = buf.find(b'\n', 0, max_bytes)
+        while end < 0 and len(buf) < max_bytes:
+            start = len(buf)
+            if not self._fill(deadline, gap=bool(buf)):
+                if not buf:
+                    raise TimeoutError('No reply from %s' % self.addr)
+                break
+            end = buf.find(b'\n', start, max_bytes)
+        end = end+1 if end >= 0 else max_bytes
+        line = bytes(buf[:end])
+        del buf[:end]
+        return line
+
+    def invalidate(self):
+        """
+        Drop the cached status so the next read goes to the PSU.
+        """
+        self._status_cache = None
 
     @property
     def status(self)->_Dict[str, _Union[bool,str]]:
-        self._send_cmd(_KORAD_STATUS_CMD)
-        status = ord(self._port.readline().rstrip().decode('utf-8'))
-        # print('{0:08b}'.format(status))
-        # parse status as described in notes:
-        status_dict = {'output':bool(status&(1<<6)),
-                       'mode':'CV' if status&1 else 'CC',
-                       'ocp':bool(status&(1<<5)),
-                       'v_out':self.measured_voltage(),
-                       'i_out':self.measured_current(),
-                       'v_set':self.configured_voltage(),
-                       'i_set':self.configured_current(),
-                       }
-        return status_dict
+        if self._status_cache is not None and _monotonic() - self._status_ts < self.status_ttl:
+            return self._status_cache.copy()
+        raw = self._query_many([_KORAD_STATUS_CMD,
+                                _KORAD_VMEAS_CMD(1),
+                                _KORAD_IMEAS_CMD(1),
+                                _KORAD_VREAD_CMD(1),
+                                _KORAD_IREAD_CMD(1),
+                                ])
+        v_out, i_out, v_set, i_set = (float(x) for x in raw[1:])
+        status_dict = _STATUS_TABLE[raw[0][0]].copy()
+        status_dict.update(v_out=v_out, i_out=i_out, v_set=v_set, i_set=i_set)
+        # these can change on the unit itself, e.g. when OCP trips or a knob is turned
+        self._last_output = int(status_dict['output'])
+        self._last_ocp = int(status_dict['ocp'])
+        self._last_v[1] = _KORAD_VSET_CMD(1, v_set)
+        self._last_i[1] = _KORAD_ISET_CMD(1, i_set)
+        self._status_cache = status_dict
+        self._status_ts = _monotonic()
+        return status_dict.copy()
     
     def _identify(self)->str:
-        self._send_cmd(_KORAD_ID_CMD)
-        id = self._port.readline().rstrip().decode('utf-8')
+        raw = self._query(_KORAD_ID_CMD, _KORAD_MAX_ID_REPLY)
         # info inferred from model number
-        model_info = _KORAD_MODEL_REGEX.match(id).groupdict()
-        channels = 1 if model_info['channels'] == '0' else 3
-        max_current = int(model_info['max_current'])
-        max_voltage = int(model_info['max_voltage']+'0')
-        return id, channels, max_voltage, max_current
+        channels, max_voltage, max_current = _parse_model(raw)
+        return raw.rstrip().decode('ascii'), channels, max_voltage, max_current
     
     def measured_voltage(self,ch=1):
-        self._send_cmd(_KORAD_VMEAS_CMD(ch))
-        return float(self._port.readline().rstrip().decode('utf-8'))
+        return float(self._query(_KORAD_VMEAS_CMD(ch)))
     
     def measured_current(self,ch=1):
-        self._send_cmd(_KORAD_IMEAS_CMD(ch))
-        return float(self._port.readline().rstrip().decode('utf-8'))
+        return float(self._query(_KORAD_IMEAS_CMD(ch)))
     
     def configured_voltage(self,ch=1):
-        self._send_cmd(_KORAD_VREAD_CMD(ch))
-        return float(self._port.readline().rstrip().decode('utf-8'))
+        return float(self._query(_KORAD_VREAD_CMD(ch)))
     
     def configured_current(self,ch=1):
-        self._send_cmd(_KORAD_IREAD_CMD(ch))
-        return float(self._port.readline().rstrip().decode('utf-8'))
+        return float(self._query(_KORAD_IREAD_CMD(ch)))
     
+    def _limit(self,value,max_value,name):
+        if not self.clamp and value > max_value:
+            raise ValueError('%s Too large: %s is greater than max %s of %s' % (name, value, name.lower(), max_value))
+        return _clamp(value, 0, max_value)
+
+    def _forget_settings(self):
+        # the PSU's settings may have changed behind our back, so don't skip
+        # any set command until it has been sent again
+        self._last_output = None
+        self._last_ocp = None
+        self._last_v = {}
+        self._last_i = {}
+
     def set_voltage(self,ch,voltage):
-        if voltage < 0:
-            voltage = 0
-        elif voltage > self.max_voltage:
-            if self.clamp:
-                voltage = self.max_voltage
-            else:
-                raise ValueError('Voltage Too large: %s is greater than max voltage of %s' % voltage, self.max_voltage)
-        self._send_cmd(_KORAD_VSET_CMD(ch,voltage))
+        # raise any pending write error first, the skip below relies on the last write having worked
+        self._check_io()
+        cmd = _KORAD_VSET_CMD(ch,self._limit(voltage, self.max_voltage, 'Voltage'))
+        if self._last_v.get(ch) == cmd:
+            return
+        self._write(cmd)
+        self._last_v[ch] = cmd
+        self.invalidate()
     
     def set_current(self,ch,current):
-        if current < 0:
-            current = 0
-        elif current > self.max_current:
-            if self.clamp:
-                current = self.max_current
-            else:
-                raise ValueError('Current Too large: %s is greater than max current of %s' % current, self.max_current)
-        self._send_cmd(_KORAD_ISET_CMD(ch,current))
+        self._check_io()
+        cmd = _KORAD_ISET_CMD(ch,self._limit(current, self.max_current, 'Current'))
+        if self._last_i.get(ch) == cmd:
+            return
+        self._write(cmd)
+        self._last_i[ch] = cmd
+        self.invalidate()
     
     def set_output(self,enable:bool):
+        self._check_io()
         enable = 1 if enable else 0 
-        self._send_cmd(_KORAD_OUTPUT_CMD(enable))
+        if enable == self._last_output:
+            return
+        self._write(_KORAD_OUTPUT_CMD(enable))
+        self._last_output = enable
+        self.invalidate()
     
     def save_settings(self,loc:int):
-        self._send_cmd(_KORAD_SAVE_CMD(loc))
+        self._write(_KORAD_SAVE_CMD(loc))
     
     def recall_settings(self,loc:int):
-        self._send_cmd(_KORAD_RECALL_CMD(loc))
+        self._write(_KORAD_RECALL_CMD(loc))
+        self._forget_settings()
+        self.invalidate()
     
     def set_ocp(self,enable:bool):
+        self._check_io()
         enable = 1 if enable else 0
-        self._send_cmd(_KORAD_OCP_CMD(enable))
+        if enable == self._last_ocp:
+            return
+        self._write(_KORAD_OCP_CMD(enable))
+        self._last_ocp = enable
+        self.invalidate()
     
     def close(self):
-        self._port.close()
+        if self._port is not None:
+            self._finalizer()
 
     def configure(self,params:dict):
-        self.set_output(params.get('output',False))
-        self.set_ocp(params.get('ocp',False))
-        if params.get('voltage',False):
-            for entry in params['voltage']:
-                self.set_voltage(**entry)
-        if params.get('current',False):
-            for entry in params['current']:
-                self.set_current(**entry)
+        """
+        Apply output, ocp, voltage and current settings in a single write,
+        leaving out any that are already set.
+        """
+        self._check_io()
+        max_voltage, max_current = self.max_voltage, self.max_current
+        output = 1 if params.get('output',False) else 0
+        ocp = 1 if params.get('ocp',False) else 0
+        v_cmds = {e['ch']: _KORAD_VSET_CMD(e['ch'], self._limit(e['voltage'], max_voltage, 'Voltage'))
+                  for e in params.get('voltage') or ()}
+        i_cmds = {e['ch']: _KORAD_ISET_CMD(e['ch'], self._limit(e['current'], max_current, 'Current'))
+                  for e in params.get('current') or ()}
+        cmds = []
+        if output != self._last_output:
+            cmds.append(_KORAD_OUTPUT_CMD(output))
+        if ocp != self._last_ocp:
+            cmds.append(_KORAD_OCP_CMD(ocp))
+        cmds += [cmd for ch, cmd in v_cmds.items() if self._last_v.get(ch) != cmd]
+        cmds += [cmd for ch, cmd in i_cmds.items() if self._last_i.get(ch) != cmd]
+        if not cmds:
+            return
+        self._submit(cmds)
+        self._last_output = output
+        self._last_ocp = ocp
+        self._last_v.update(v_cmds)
+        self._last_i.update(i_cmds)
+        self.invalidate()
 
     # def __del__(self):
         # self.close()
 
 
+class KoradFast(Korad):
+    """
+    Korad for high-rate polling: single queries skip the I/O worker and are
+    written and read on the calling thread, straight on the port's descriptor.
+    Falls back to the regular path on ports without one (e.g. on Windows).
+    """
+    __slots__ = ()
+
+    def _query(self,cmd,max_bytes=_KORAD_MAX_NUMERIC_REPLY):
+        self._check_io()
+        if self._fd is None:
+            return super()._query(cmd, max_bytes)
+        # commands queued before this one go out first
+        self._cmd_q.join()
+        with self._io_lock:
+            self._wait_ready()
+            self._drop_input()
+            out = cmd
+            while out:
+                out = out[_os.write(self._fd, out):]
+            return self._read_replies([cmd], max_bytes)[0]
+
+
 # Function Interface
 # todo: implement clamping. 
-def _send_cmd(addr,command,timeout=_KORAD_MAX_TIMEOUT):
-    with _serial.Serial(addr,baudrate=_KORAD_BAUD,parity=_KORAD_PARITY,rtscts=_KORAD_DATA_FLOW_CTRL,
-                        dsrdtr=_KORAD_DATA_FLOW_CTRL,timeout=_KORAD_MAX_TIMEOUT) as port:
+
+# ports are kept open between calls, keyed by their configuration, each with a
+# lock so concurrent callers don't interleave commands on the same port; the
+# least recently used one is closed once there are more than _PORT_POOL_SIZE
+_PORT_POOL = _OrderedDict()  # type: _Dict[tuple, _Tuple[_serial.Serial, _threading.Lock]]
+_PORT_POOL_LOCK = _threading.Lock()
+_PORT_POOL_SIZE = 8
+
+def _close_quietly(port):
+    try:
+        port.close()
+    except Exception:
+        pass
+
+def _get_port(addr,timeout=_KORAD_MAX_TIMEOUT)->_Tuple[_serial.Serial, _threading.Lock]:
+    key = (addr, _KORAD_BAUD, _KORAD_PARITY, timeout)
+    evicted = []
+    with _PORT_POOL_LOCK:
+        entry = _PORT_POOL.get(key)
+        if entry is None or not entry[0].is_open:
+            port = _serial.Serial(addr,baudrate=_KORAD_BAUD,parity=_KORAD_PARITY,rtscts=_KORAD_DATA_FLOW_CTRL,
+                                  dsrdtr=_KORAD_DATA_FLOW_CTRL,timeout=timeout)
+            entry = _PORT_POOL[key] = (port, _threading.Lock())
+            while len(_PORT_POOL) > _PORT_POOL_SIZE:
+                evicted.append(_PORT_POOL.popitem(last=False)[1])
+        _PORT_POOL.move_to_end(key)
+    # wait for anyone still using an evicted port, outside the pool lock
+    for port, lock in evicted:
+        with lock:
+            _close_quietly(port)
+    return entry
+
+def _acquire_port(addr,timeout=_KORAD_MAX_TIMEOUT)->_Tuple[_serial.Serial, _threading.Lock]:
+    # another thread can evict the port between _get_port and taking its lock;
+    # the pool then opens a fresh one, which as the most recently used is the
+    # last to go, so one retry is enough
+    for _ in range(2):
+        port, lock = _get_port(addr, timeout)
+        lock.acquire()
+        if port.is_open:
+            return port, lock
+        lock.release()
+    raise _serial.SerialException('Port %s was closed while waiting for it' % addr)
+
+def _drop_port(port,lock):
+    # a port that failed (e.g. its adapter was unplugged) is reopened on next use
+    with _PORT_POOL_LOCK:
+        for key in [k for k, (p, _) in _PORT_POOL.items() if p is port]:
+            del _PORT_POOL[key]
+    # wait for anyone still using it, as for evicted ports
+    with lock:
+        _close_quietly(port)
+
+@_atexit.register
+def _close_ports():
+    with _PORT_POOL_LOCK:
+        for port, _ in _PORT_POOL.values():
+            _close_quietly(port)
+        _PORT_POOL.clear()
+
+def _cmd(addr,command,parse=None,max_bytes=_KORAD_MAX_NUMERIC_REPLY,timeout=_KORAD_MAX_TIMEOUT):
+    """
+    Send a command on a pooled port. Queries pass `parse`, which is applied
+    to the reply and its result returned.
+    """
+    port, lock = _acquire_port(addr, timeout)
+    failed = False
+    try:
+        # a freshly opened port starts empty; drop any reply left unread by a previous call
+        port.reset_input_buffer()
         port.write(command)
-    _sleep(timeout)
+        if parse is None:
+            # hold the port until the PSU has processed the set command
+            _sleep(_KORAD_SET_DELAY)
+            return None
+        reply = port.read_until(b'\n', max_bytes)
+        if command == _KORAD_STATUS_CMD and reply:
+            # the status byte can itself be b'\n', so it is read on its own and
+            # its terminator, which may still be on its way, drained here
+            port.read_until(b'\n', 1)
+    except (_serial.SerialException, OSError):
+        failed = True
+        raise
+    finally:
+        lock.release()
+        if failed:
+            _drop_port(port, lock)
+    if not reply:
+        raise TimeoutError('No reply from %s' % addr)
+    return parse(reply)
 
 def korad_set_voltage(addr:str,ch:int,voltage:_Real, clamp):
-    _send_cmd(addr, _KORAD_VSET_CMD(ch,voltage))
+    _cmd(addr, _KORAD_VSET_CMD(ch,voltage))
 
 def korad_set_current(addr:str,ch:int,current:_Real, clamp):
-    _send_cmd(addr, _KORAD_ISET_CMD(ch,current))
+    _cmd(addr, _KORAD_ISET_CMD(ch,current))
 
-def korad_get_desired_voltage(addr:str,ch:int):
-    _send_cmd(addr, _KORAD_VREAD_CMD(ch))
+def korad_get_desired_voltage(addr:str,ch:int)->float:
+    return _cmd(addr, _KORAD_VREAD_CMD(ch), float)
 
-def korad_get_desired_current(addr:str,ch:int):
-    _send_cmd(addr, _KORAD_IREAD_CMD(ch))
+def korad_get_desired_current(addr:str,ch:int)->float:
+    return _cmd(addr, _KORAD_IREAD_CMD(ch), float)
 
-def korad_get_actual_voltage(addr:str,ch:int):
-    _send_cmd(addr, _KORAD_VMEAS_CMD(ch))
+def korad_get_actual_voltage(addr:str,ch:int)->float:
+    return _cmd(addr, _KORAD_VMEAS_CMD(ch), float)
 
-def korad_get_actual_current(addr:str,ch:int):
-    _send_cmd(addr, _KORAD_IMEAS_CMD(ch))
+def korad_get_actual_current(addr:str,ch:int)->float:
+    return _cmd(addr, _KORAD_IMEAS_CMD(ch), float)
 
 def korad_set_output(addr:str,enable:bool):
-    enable = 1 if enable else 0
-    _send_cmd(addr, _KORAD_OUTPUT_CMD(enable))
+    _cmd(addr, _KORAD_OUTPUT_CMD(1 if enable else 0))
 
 def korad_set_ocp(addr:str,enable:bool):
-    enable = 1 if enable else 0
-    _send_cmd(addr, _KORAD_OCP_CMD(enable))
-
-def korad_identify(addr:str):
-    with _serial.Serial(addr,baudrate=_KORAD_BAUD,parity=_KORAD_PARITY,rtscts=_KORAD_DATA_FLOW_CTRL,
-                        dsrdtr=_KORAD_DATA_FLOW_CTRL,timeout=_KORAD_MAX_TIMEOUT) as port:
-        port.write(_KORAD_ID_CMD)
-        res = port.readline().rstrip().decode('utf-8')
-    return res
-
-def korad_status(addr:str):
-    with _serial.Serial(addr,baudrate=_KORAD_BAUD,parity=_KORAD_PARITY,rtscts=_KORAD_DATA_FLOW_CTRL,
-                        dsrdtr=_KORAD_DATA_FLOW_CTRL,timeout=_KORAD_MAX_TIMEOUT) as port:
-        port.write(_KORAD_STATUS_CMD)
-        status = ord(port.readline().rstrip().decode('utf-8'))
-    status_dict = {'output':bool(status&(1<<6)),
-                   'mode':'CV' if status&1 else 'CC',
-                   'ocp':bool(status&(1<<5)),
-                   }
-    return status_dict
+    _cmd(addr, _KORAD_OCP_CMD(1 if enable else 0))
+
+def korad_identify(addr:str)->str:
+    return _cmd(addr, _KORAD_ID_CMD, lambda r: r.rstrip().decode('ascii'), _KORAD_MAX_ID_REPLY)
+
+def korad_status(addr:str)->_Dict[str, _Union[bool,str]]:
+    return _cmd(addr, _KORAD_STATUS_CMD, lambda r: _STATUS_TABLE[r[0]].copy(), 1)
 
 def korad_save_settings(addr:str,loc:int):
-    _send_cmd(addr, _KORAD_SAVE_CMD(loc))
+    _cmd(addr, _KORAD_SAVE_CMD(loc))
 
 def korad_load_settings(addr:str,loc:int):
-    _send_cmd(addr, _KORAD_RECALL_CMD(loc))
+    _cmd(addr, _KORAD_RECALL_CMD(loc))
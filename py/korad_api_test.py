@@ -1,5 +1,15 @@
+import gc
+import os
+import re
+import select
+import serial
+import threading
+import time
 import unittest
+import weakref
+import korad_api
 from korad_api import *
+from korad_api import _KORAD_SET_DELAY, _PORT_POOL, _STATUS_TABLE, _close_ports, _drop_port, _get_port, _parse_model
 
 
 TEST_KORAD_INFO = {
@@ -59,7 +69,413 @@ class KoradObjectTests(unittest.TestCase):
         self.assertEqual(status['i_out'],0,'ouput may not be disabled')
         self.psu.set_output(True)
 
-# todo: implement tests for functional interface
+class KoradStatusDecodeTests(unittest.TestCase):
+    def test_status_table(self):
+        self.assertEqual(_STATUS_TABLE[0b01000001], {'output':True,'mode':'CV','ocp':False})
+        self.assertEqual(_STATUS_TABLE[0b00100000], {'output':False,'mode':'CC','ocp':True})
+        self.assertEqual(_STATUS_TABLE[0b10011110], {'output':False,'mode':'CC','ocp':False})
+
+class KoradModelParseTests(unittest.TestCase):
+    def test_parse_model(self):
+        self.assertEqual(_parse_model(TEST_KORAD_INFO['id'].encode('ascii')), (1, 30, 5))
+        self.assertEqual(_parse_model(b'KORAD KA3305P V5.8\n'), (3, 30, 5))
+        self.assertEqual(_parse_model(b'korad kd6010p v1.1'), (1, 60, 10))
+        self.assertRaises(ValueError, _parse_model, b'KORAD V2.0')
+
+
+class FakeKorad:
+    """
+    Stand-in PSU on a pseudo terminal, for the tests that need no hardware.
+    Replies after `delay` seconds, or after `delays[cmd]` for a given command,
+    and logs every command it receives with its arrival time. With `byte_delay`
+    replies are sent a byte at a time, as a UART would deliver them.
+    """
+    CMD_REGEX = re.compile(rb'\*IDN\?|STATUS\?|(VSET|ISET|VOUT|IOUT)\d\?|(VSET|ISET)\d:([0-9.]+)|(OUT|OCP|SAV|RCL)(\d)')
+
+    def __init__(self, delay=2e-3, delays=None, byte_delay=0):
+        import tty
+        self.delay = delay
+        self.delays = delays or {}
+        self.byte_delay = byte_delay
+        self.v, self.i, self.out, self.ocp = 0.0, 0.0, 0, 0
+        self.status = None  # raw STATUS? byte to send instead of the one built from out and ocp
+        self.log = []
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def count(self, cmd):
+        return sum(1 for _, c in self.log if c == cmd)
+
+    def close(self):
+        # hanging up wakes the reader, which closes the master itself so its
+        # descriptor can't be reused by the next fake while still being read
+        os.close(self._slave)
+        self._thread.join()
+
+    def _read_more(self, timeout):
+        if not select.select([self._master], [], [], timeout)[0]:
+            return b''
+        try:
+            return os.read(self._master, 256)
+        except OSError:
+            return None
+
+    def _reply(self, cmd, reply):
+        time.sleep(self.delays.get(cmd, self.delay))
+        reply += b'\n'
+        if not self.byte_delay:
+            os.write(self._master, reply)
+            return
+        for i in range(len(reply)):
+            os.write(self._master, reply[i:i+1])
+            time.sleep(self.byte_delay)
+
+    def _run(self):
+        buf = b''
+        while True:
+            chunk = self._read_more(None)
+            if not chunk:
+                os.close(self._master)
+                return
+            buf += chunk
+            while True:
+                m = self.CMD_REGEX.match(buf)
+                if not m:
+                    break
+                if m.group(3) and m.end() == len(buf):
+                    # the value of a set command may still be arriving
+                    more = self._read_more(20e-3)
+                    if more:
+                        buf += more
+                        continue
+                buf = buf[m.end():]
+                cmd = m.group(0)
+                self.log.append((time.monotonic(), cmd))
+                if cmd == b'*IDN?':
+                    self._reply(cmd, b'KORAD KD3005P V2.0')
+                elif cmd == b'STATUS?':
+                    status = self.status
+                    if status is None:
+                        status = (self.out << 6) | (self.ocp << 5) | 1
+                    self._reply(cmd, bytes([status]))
+                elif m.group(1):
+                    value = {b'VSET': self.v, b'ISET': self.i,
+                             b'VOUT': self.v*self.out, b'IOUT': self.i*self.out/2}[m.group(1)]
+                    self._reply(cmd, b'%.3f' % value)
+                elif m.group(2) == b'VSET':
+                    self.v = float(m.group(3))
+                elif m.group(2) == b'ISET':
+                    self.i = float(m.group(3))
+                elif m.group(4) == b'OUT':
+                    self.out = int(m.group(5))
+                elif m.group(4) == b'OCP':
+                    self.ocp = int(m.group(5))
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pseudo terminal')
+class KoradFakeTestCase(unittest.TestCase):
+    psu_class = Korad
+    byte_delay = 0
+
+    def setUp(self):
+        self.fake = FakeKorad(byte_delay=self.byte_delay)
+        self.psu = self.psu_class(self.fake.path)
+
+    def tearDown(self):
+        self.psu.close()
+        self.fake.close()
+
+    def settle(self):
+        # let the worker send everything queued so far, and the PSU take it in
+        self.psu._cmd_q.join()
+        time.sleep(2*_KORAD_SET_DELAY)
+
+class KoradSkipCacheTests(KoradFakeTestCase):
+    def test_unchanged_settings_not_resent(self):
+        self.psu.set_output(True)
+        self.psu.set_output(True)
+        self.psu.set_voltage(1, 5)
+        self.psu.set_voltage(1, 5)
+        self.settle()
+        self.assertEqual(self.fake.count(b'OUT1'), 1)
+        self.assertEqual(self.fake.count(b'VSET1:5.00'), 1)
+
+    def test_configure_sends_only_changes(self):
+        config = {'output':True, 'ocp':False, 'voltage':[{'ch':1, 'voltage':5}], 'current':[{'ch':1, 'current':1}]}
+        self.psu.configure(config)
+        self.psu.configure(config)
+        self.psu.configure(dict(config, current=[{'ch':1, 'current':2}]))
+        self.settle()
+        self.assertEqual(self.fake.count(b'OUT1'), 1)
+        self.assertEqual(self.fake.count(b'OCP0'), 1)
+        self.assertEqual(self.fake.count(b'VSET1:5.00'), 1)
+        self.assertEqual(self.fake.count(b'ISET1:1.000'), 1)
+        self.assertEqual(self.fake.count(b'ISET1:2.000'), 1)
+
+    def test_recall_forgets_settings(self):
+        self.psu.set_output(True)
+        self.psu.recall_settings(1)
+        self.psu.set_output(True)
+        self.settle()
+        self.assertEqual(self.fake.count(b'OUT1'), 2)
+
+    def test_failed_write_forgets_settings(self):
+        self.psu.set_output(True)
+        self.settle()
+        write = self.psu._port.write
+        def fail(data):
+            self.psu._port.write = write
+            raise OSError('write failed')
+        self.psu._port.write = fail
+        self.psu.set_output(False)
+        self.psu._cmd_q.join()
+        # the error is raised on the next call, which must not be skipped afterwards
+        self.assertRaises(OSError, self.psu.set_output, False)
+        self.psu.set_output(False)
+        self.settle()
+        self.assertEqual(self.fake.count(b'OUT0'), 1)
+        self.assertEqual(self.fake.out, 0)
+
+    def test_status_resyncs_settings(self):
+        self.psu.set_output(True)
+        self.settle()
+        self.fake.out = 0  # e.g. tripped by ocp
+        self.psu.invalidate()
+        self.assertFalse(self.psu.status['output'])
+        self.psu.set_output(True)
+        self.settle()
+        self.assertEqual(self.fake.count(b'OUT1'), 2)
+
+    def test_status_resyncs_setpoints(self):
+        self.psu.set_voltage(1, 5)
+        self.psu.set_current(1, 1)
+        self.settle()
+        self.fake.v, self.fake.i = 7.0, 0.5  # changed on the front panel
+        self.psu.invalidate()
+        self.assertEqual((self.psu.status['v_set'], self.psu.status['i_set']), (7.0, 0.5))
+        self.psu.set_voltage(1, 5)
+        self.psu.set_current(1, 1)
+        self.psu.set_current(1, 1)
+        self.settle()
+        self.assertEqual(self.fake.count(b'VSET1:5.00'), 2)
+        self.assertEqual(self.fake.count(b'ISET1:1.000'), 2)
+        self.assertEqual((self.fake.v, self.fake.i), (5.0, 1.0))
+
+    def test_skip_checks_pending_error(self):
+        self.psu.set_output(True)
+        self.settle()
+        self.psu._io_error = OSError('write failed')
+        self.assertRaises(OSError, self.psu.set_output, True)
+
+class KoradStatusCacheTests(KoradFakeTestCase):
+    def test_status_cached_within_ttl(self):
+        self.assertEqual(self.psu.status, dict(_STATUS_TABLE[0b00000001], v_out=0, i_out=0, v_set=0, i_set=0))
+        self.psu.status['output'] = True  # callers get a copy
+        self.assertFalse(self.psu.status['output'])
+        self.assertEqual(self.fake.count(b'STATUS?'), 1)
+        time.sleep(2*self.psu.status_ttl)
+        self.psu.status
+        self.assertEqual(self.fake.count(b'STATUS?'), 2)
+
+    def test_set_invalidates_status(self):
+        self.assertFalse(self.psu.status['output'])
+        self.psu.set_output(True)
+        self.assertTrue(self.psu.status['output'])
+        self.assertEqual(self.fake.count(b'STATUS?'), 2)
+
+class KoradFramingTests(KoradFakeTestCase):
+    def test_late_reply_dropped(self):
+        self.fake.v, self.fake.i, self.fake.out = 3.29, 0.01, 1
+        self.fake.delays[b'IOUT1?'] = 1.5*self.psu.timeout
+        self.assertRaises(TimeoutError, self.psu.measured_current, 1)
+        time.sleep(self.psu.timeout)
+        # the late current reply must not be taken for the voltage
+        self.assertEqual(self.psu.measured_voltage(1), 3.29)
+        del self.fake.delays[b'IOUT1?']
+        self.assertEqual(self.psu.measured_current(1), 0.005)
+
+    def test_status_byte_is_newline(self):
+        self.fake.status = 0x0a
+        self.fake.v, self.fake.out = 1.5, 1
+        for _ in range(3):
+            self.psu.invalidate()
+            self.assertEqual(self.psu.status, dict(_STATUS_TABLE[0x0a], v_out=1.5, i_out=0, v_set=1.5, i_set=0))
+            self.assertEqual(self.psu.measured_voltage(1), 1.5)
+            self.assertEqual(self.psu.configured_voltage(1), 1.5)
+
+    def test_pipelined_replies_in_order(self):
+        self.fake.v, self.fake.i, self.fake.out = 12.5, 0.25, 1
+        self.assertEqual(self.psu._query_many([b'VSET1?', b'ISET1?', b'VOUT1?']), [b'12.500\n', b'0.250\n', b'12.500\n'])
+
+class KoradPacedFramingTests(KoradFramingTests):
+    byte_delay = 1e-3
+
+class KoradFastFramingTests(KoradFramingTests):
+    psu_class = KoradFast
+
+class KoradFastPacedFramingTests(KoradPacedFramingTests):
+    psu_class = KoradFast
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pseudo terminal')
+class KoradFunctionalTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeKorad()
+
+    def tearDown(self):
+        korad_api._PORT_POOL_SIZE = 8
+        korad_api._get_port = _get_port
+        _close_ports()
+        self.fake.close()
+
+    def test_set_and_get(self):
+        korad_set_voltage(self.fake.path, 1, 4.2, True)
+        korad_set_output(self.fake.path, True)
+        self.assertEqual(korad_get_desired_voltage(self.fake.path, 1), 4.2)
+        self.assertEqual(korad_get_actual_voltage(self.fake.path, 1), 4.2)
+        self.assertEqual(korad_identify(self.fake.path), 'KORAD KD3005P V2.0')
+
+    def test_status_byte_is_newline(self):
+        self.fake.status, self.fake.v = 0x0a, 1.5
+        self.fake.byte_delay = 1e-3  # the terminator arrives after the status byte
+        for _ in range(3):
+            self.assertEqual(korad_status(self.fake.path), _STATUS_TABLE[0x0a])
+            self.assertEqual(korad_get_desired_voltage(self.fake.path, 1), 1.5)
+
+    def test_failed_port_dropped(self):
+        korad_identify(self.fake.path)
+        port, _ = _get_port(self.fake.path)
+        def fail(data):
+            raise serial.SerialException('device disconnected')
+        port.write = fail
+        self.assertRaises(serial.SerialException, korad_identify, self.fake.path)
+        self.assertNotIn(port, [p for p, _ in _PORT_POOL.values()])
+        self.assertFalse(port.is_open)
+        self.assertEqual(korad_identify(self.fake.path), 'KORAD KD3005P V2.0')
+
+    def test_pool_bounded(self):
+        korad_api._PORT_POOL_SIZE = 1
+        other = FakeKorad()
+        try:
+            korad_identify(self.fake.path)
+            port, _ = _get_port(self.fake.path)
+            korad_identify(other.path)
+            self.assertEqual(len(_PORT_POOL), 1)
+            self.assertFalse(port.is_open)
+            self.assertEqual(korad_identify(self.fake.path), 'KORAD KD3005P V2.0')
+        finally:
+            _close_ports()
+            other.close()
+
+    def test_port_evicted_before_use(self):
+        korad_api._PORT_POOL_SIZE = 1
+        other = FakeKorad()
+        def get_port_then_evict(addr, timeout):
+            # another thread evicts the port before this one gets to lock it
+            korad_api._get_port = _get_port
+            entry = _get_port(addr, timeout)
+            korad_identify(other.path)
+            return entry
+        try:
+            korad_api._get_port = get_port_then_evict
+            self.assertEqual(korad_identify(self.fake.path), 'KORAD KD3005P V2.0')
+        finally:
+            _close_ports()
+            other.close()
+
+    def test_dropped_port_closed_once_free(self):
+        korad_identify(self.fake.path)
+        port, lock = _get_port(self.fake.path)
+        with lock:
+            dropper = threading.Thread(target=_drop_port, args=(port, lock))
+            dropper.start()
+            dropper.join(0.05)
+            self.assertTrue(port.is_open, 'closed while in use')
+        dropper.join()
+        self.assertFalse(port.is_open)
+
+
+class KoradConfigureTests(KoradFakeTestCase):
+    def test_configure_waits_for_every_command(self):
+        start = time.monotonic()
+        self.psu.configure({'output':True, 'ocp':True, 'voltage':[{'ch':1, 'voltage':5}], 'current':[{'ch':1, 'current':1}]})
+        self.psu.status
+        (sent, _), = [e for e in self.fake.log if e[1] == b'STATUS?']
+        self.assertGreaterEqual(sent - start, 0.9*4*_KORAD_SET_DELAY)
+        self.assertEqual((self.fake.v, self.fake.i, self.fake.out, self.fake.ocp), (5.0, 1.0, 1, 1))
+
+class KoradLifecycleTests(KoradFakeTestCase):
+    def test_use_after_close(self):
+        self.psu.status
+        thread = self.psu._io_thread
+        self.psu.close()
+        self.assertFalse(thread.is_alive())
+        self.assertRaises(serial.SerialException, self.psu.set_output, True)
+        self.assertRaises(serial.SerialException, self.psu.measured_voltage, 1)
+        self.psu.close()
+
+    def test_query_during_close(self):
+        self.fake.delays[b'VSET1?'] = self.psu.timeout/2
+        busy = threading.Thread(target=self.psu.configured_voltage, args=(1,))
+        busy.start()
+        time.sleep(self.psu.timeout/10)  # the worker now waits for the slow reply
+        closer = threading.Thread(target=self.psu.close)
+        closer.start()
+        time.sleep(self.psu.timeout/10)  # close() has queued the worker's stop
+        errors = []
+        def query():
+            try:
+                self.psu.configured_voltage(1)
+            except serial.SerialException as e:
+                errors.append(e)
+        late = threading.Thread(target=query, daemon=True)
+        late.start()
+        late.join(1)
+        self.assertFalse(late.is_alive(), 'query issued during close() never returned')
+        self.assertEqual(len(errors), 1)
+        busy.join()
+        closer.join()
+
+    def test_collected_when_unused(self):
+        self.psu.set_output(True)
+        self.psu.status
+        self.psu._cmd_q.join()
+        port, thread, ref = self.psu._port, self.psu._io_thread, weakref.ref(self.psu)
+        del self.psu
+        gc.collect()
+        self.assertIsNone(ref())
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(port.is_open)
+        self.psu = Korad(self.fake.path)  # for tearDown
+
+class KoradOpenTests(KoradFakeTestCase):
+    def test_concurrent_first_use(self):
+        self.fake.v = 2.0
+        results, errors = [], []
+        def query():
+            try:
+                results.append(self.psu.configured_voltage(1))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=query) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [2.0]*8)
+        self.assertEqual(self.fake.count(b'VSET1?'), 8)
+
+    def test_connect_retry(self):
+        self.fake.delays[b'*IDN?'] = 1.5*self.psu.timeout  # e.g. still powering up
+        self.assertRaises(TimeoutError, self.psu.connect)
+        del self.fake.delays[b'*IDN?']
+        time.sleep(self.psu.timeout)
+        self.psu.connect()
+        self.assertEqual(self.psu.id, 'KORAD KD3005P V2.0')
+        self.assertEqual(self.psu.configured_voltage(1), 0)
 
 if __name__ == "__main__":
     unittest.main()